@@ -1,20 +1,81 @@
 import os
-import json
+import asyncio
+import base64
+import hashlib
+import hmac
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
+from urllib.parse import parse_qsl, quote
+from xml.sax.saxutils import escape
 
-from fastapi import FastAPI, Form, Request
-from fastapi.responses import PlainTextResponse, JSONResponse, Response
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+import orjson
 
+import httpx
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 # --------------------------------------------------------------------
 # FASTAPI APP
 # --------------------------------------------------------------------
-app = FastAPI()
-logging.basicConfig(level=logging.INFO)
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (FastAPI's own ORJSONResponse is deprecated)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+class TwiMLResponse(Response):
+    """Prebuilt TwiML bytes sent as-is with an XML content type."""
+
+    media_type = "text/xml"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global _http_client
+    # Google only gzips responses when the User-Agent contains "gzip";
+    # httpx already sends Accept-Encoding: gzip.
+    _http_client = httpx.AsyncClient(
+        # HTTP/2 lets concurrent Calendar inserts share one TLS connection
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        headers={"User-Agent": "maxi-backend (gzip)"},
+    )
+    yield
+    await _http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# --------------------------------------------------------------------
+# LOGGING
+# --------------------------------------------------------------------
+class OrjsonFormatter(logging.Formatter):
+    """One JSON object per log line, for log collectors that parse structured output."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+
+# uvicorn's own loggers (including "Exception in ASGI application" tracebacks
+# from uvicorn.error) propagate to this root handler; the runner below passes
+# log_config=None so uvicorn does not install its plain-text handlers.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+_log_handler = logging.StreamHandler()
+if LOG_FORMAT == "json":
+    _log_handler.setFormatter(OrjsonFormatter())
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
 logger = logging.getLogger("maxi-backend")
 
 # --------------------------------------------------------------------
@@ -23,65 +84,98 @@ logger = logging.getLogger("maxi-backend")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_FROM_NUMBER = os.getenv("TWILIO_FROM_NUMBER")
+# Opt-in: the URL Twilio signs must match request.url, which needs proxy
+# headers to be trusted when TLS is terminated in front of uvicorn.
+TWILIO_VALIDATE_SIGNATURE = os.getenv("TWILIO_VALIDATE_SIGNATURE", "").lower() in ("1", "true", "yes")
 
 ELEVENLABS_AGENT_ID = os.getenv("ELEVENLABS_AGENT_ID", "default_agent_id")
 
 GOOGLE_CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID")
 GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 TIMEZONE = os.getenv("TIMEZONE", "America/Los_Angeles")
+CALENDAR_ENABLED = bool(GOOGLE_SERVICE_ACCOUNT_JSON and GOOGLE_CALENDAR_ID)
+
+REQUIRED_ENV_VARS = (
+    "TWILIO_ACCOUNT_SID",
+    "TWILIO_AUTH_TOKEN",
+    "TWILIO_FROM_NUMBER",
+    "GOOGLE_CALENDAR_ID",
+    "GOOGLE_SERVICE_ACCOUNT_JSON",
+)
 
-missing = []
-if not TWILIO_ACCOUNT_SID:
-    missing.append("TWILIO_ACCOUNT_SID")
-if not TWILIO_AUTH_TOKEN:
-    missing.append("TWILIO_AUTH_TOKEN")
-if not TWILIO_FROM_NUMBER:
-    missing.append("TWILIO_FROM_NUMBER")
-if not GOOGLE_CALENDAR_ID:
-    missing.append("GOOGLE_CALENDAR_ID")
-if not GOOGLE_SERVICE_ACCOUNT_JSON:
-    missing.append("GOOGLE_SERVICE_ACCOUNT_JSON")
+missing = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
 
 if missing:
     logger.warning("Missing environment variables: %s", missing)
 else:
     logger.info("All expected environment variables are present.")
 
+if TWILIO_VALIDATE_SIGNATURE and not TWILIO_AUTH_TOKEN:
+    logger.error("TWILIO_VALIDATE_SIGNATURE is set but TWILIO_AUTH_TOKEN is not; rejecting all Twilio requests.")
+
+if not CALENDAR_ENABLED:
+    logger.warning("Google Calendar env vars not fully configured; skipping Calendar integration.")
+
 
-def twiml(xml: str) -> PlainTextResponse:
-    """Return TwiML with correct content-type."""
-    return PlainTextResponse(xml, media_type="application/xml")
+CALENDAR_EVENTS_URL = (
+    "https://www.googleapis.com/calendar/v3/calendars/"
+    f"{quote(GOOGLE_CALENDAR_ID or '', safe='')}/events"
+)
 
 
-def get_calendar_service():
+def load_calendar_credentials() -> Optional[service_account.Credentials]:
     """
-    Build a Google Calendar service from the JSON stored in
-    GOOGLE_SERVICE_ACCOUNT_JSON. Returns None if misconfigured.
+    Parse GOOGLE_SERVICE_ACCOUNT_JSON into service-account credentials.
+    Called once at import; returns None if unset or invalid.
     """
     if not GOOGLE_SERVICE_ACCOUNT_JSON or not GOOGLE_CALENDAR_ID:
-        logger.warning("Google Calendar env vars not fully configured; skipping Calendar integration.")
         return None
 
     try:
-        info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-        creds = service_account.Credentials.from_service_account_info(
+        info = orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+        return service_account.Credentials.from_service_account_info(
             info,
             scopes=["https://www.googleapis.com/auth/calendar"],
         )
-        service = build("calendar", "v3", credentials=creds, cache_discovery=False)
-        return service
     except Exception as e:
-        logger.error("Failed to build Google Calendar service: %s", e)
+        logger.error("Failed to load Google service account credentials: %s", e)
         return None
 
 
-def create_calendar_event(summary: str, description: str) -> None:
+_calendar_credentials = load_calendar_credentials()
+_http_client: httpx.AsyncClient  # created by lifespan() and shared by all requests
+# Token refreshes are blocking (google-auth signs a JWT and exchanges it over
+# HTTP), so they run on a dedicated thread instead of FastAPI's threadpool.
+# A single thread also means concurrent callers never refresh twice.
+_calendar_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gcal")
+# Reused across refreshes so the token endpoint connection stays pooled;
+# only ever touched from the single gcal thread.
+_google_auth_request = GoogleAuthRequest()
+
+
+def _refresh_calendar_token(credentials: service_account.Credentials) -> None:
+    if not credentials.valid:
+        credentials.refresh(_google_auth_request)
+
+
+async def get_calendar_token(credentials: service_account.Credentials) -> str:
+    """Return a valid access token, refreshing it off the event loop when expired."""
+    if not credentials.valid:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_calendar_executor, _refresh_calendar_token, credentials)
+    return credentials.token
+
+
+async def create_calendar_event(summary: str, description: str) -> None:
     """
     Create a simple 30-minute event starting 'now' on the configured calendar.
     If Calendar is not configured or fails, we just log and continue.
     """
-    service = get_calendar_service()
-    if service is None:
+    if not CALENDAR_ENABLED:
+        # Already warned once at startup
+        return
+    if _calendar_credentials is None:
+        # The parse error was already logged by load_calendar_credentials()
         return
 
     now = datetime.now(timezone.utc)
@@ -101,10 +195,21 @@ def create_calendar_event(summary: str, description: str) -> None:
     }
 
     try:
-        service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event).execute()
+        token = await get_calendar_token(_calendar_credentials)
+        response = await _http_client.post(
+            CALENDAR_EVENTS_URL,
+            # Only the id is needed, so skip the full event resource in the reply
+            params={"fields": "id"},
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json",
+            },
+            content=orjson.dumps(event),
+        )
+        response.raise_for_status()
         logger.info("Created Google Calendar event: %s", summary)
-    except HttpError as e:
-        logger.error("Google Calendar API error: %s", e)
+    except httpx.HTTPStatusError as e:
+        logger.error("Google Calendar API error: %s %s", e.response.status_code, e.response.text)
     except Exception as e:
         logger.error("Unexpected error creating Calendar event: %s", e)
 
@@ -112,14 +217,29 @@ def create_calendar_event(summary: str, description: str) -> None:
 # --------------------------------------------------------------------
 # HEALTH & VERSION
 # --------------------------------------------------------------------
+# These responses never change, so body and headers (including
+# content-length) are built once at import and the same object is returned
+# every time. Sending a Starlette Response does not mutate it, and FastAPI
+# only attaches state to a returned Response for routes that take
+# BackgroundTasks, which these do not.
+_STATUS_RESPONSE = Response(
+    content=orjson.dumps({"status": "running", "message": "Maxi backend is online."}),
+    media_type="application/json",
+)
+_VERSION_RESPONSE = Response(
+    content=orjson.dumps({"version": "1.0.0"}),
+    media_type="application/json",
+)
+
+
 @app.get("/status")
-def status():
-    return {"status": "running", "message": "Maxi backend is online."}
+async def status() -> Response:
+    return _STATUS_RESPONSE
 
 
 @app.get("/version")
-def version():
-    return {"version": "1.0.0"}
+async def version() -> Response:
+    return _VERSION_RESPONSE
 
 
 # --------------------------------------------------------------------
@@ -127,72 +247,202 @@ def version():
 # Twilio calls this endpoint when an incoming call is received.
 # This endpoint connects the call to ElevenLabs AI agent.
 # --------------------------------------------------------------------
-@app.api_route("/voice/inbound", methods=["GET", "POST"])
-async def voice_inbound(request: Request):
+# Extra entities for escaping values placed inside double-quoted attributes
+_XML_ATTR_ENTITIES = {'"': "&quot;"}
+
+# The agent id is fixed for the process, so the stream URL is built, quoted
+# and escaped once.
+ELEVENLABS_STREAM_URL = (
+    "wss://api.elevenlabs.io/v1/convai/conversation"
+    f"?agent_id={quote(ELEVENLABS_AGENT_ID, safe='')}"
+)
+
+# TwiML response that connects the call to ElevenLabs, using <Connect> with
+# <Stream> to send audio. Only the <Parameter> lines vary per call, so the
+# surrounding XML is encoded once here.
+_VOICE_INBOUND_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    "<Response><Connect>"
+    f'<Stream url="{escape(ELEVENLABS_STREAM_URL, _XML_ATTR_ENTITIES)}">'
+).encode()
+_VOICE_INBOUND_TAIL = b"</Stream></Connect></Response>"
+
+
+def twilio_signature_valid(url: str, params: list, signature: str) -> bool:
+    """
+    Check X-Twilio-Signature: base64(HMAC-SHA1(auth token, URL followed by
+    every POST parameter name and value, sorted by name)).
+    """
+    if not TWILIO_AUTH_TOKEN:
+        # Never sign with an empty key; that would let anyone forge requests
+        return False
+    data = url + "".join(name + value for name, value in sorted(params))
+    digest = hmac.new(TWILIO_AUTH_TOKEN.encode(), data.encode(), hashlib.sha1).digest()
+    # Header values are latin-1 decoded, so this round-trips any header bytes
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode("latin-1"))
+
+
+async def twilio_params(request: Request) -> dict:
+    """
+    Return the parameters Twilio sent, from the query string (GET) or the
+    urlencoded body (POST). The body is read once and parsed with parse_qsl,
+    and the same pairs are used to verify the signature when enabled.
+    """
+    if request.method == "POST":
+        body = await request.body()
+        try:
+            pairs = parse_qsl(body.decode(), keep_blank_values=True, max_num_fields=100)
+        except (UnicodeDecodeError, ValueError):
+            # Not UTF-8, or more fields than any Twilio callback sends
+            raise HTTPException(status_code=400, detail="Malformed form body")
+        signed = pairs
+    else:
+        pairs = request.query_params.multi_items()
+        signed = []  # for GET the parameters are already part of the URL
+
+    if TWILIO_VALIDATE_SIGNATURE and not twilio_signature_valid(
+        str(request.url), signed, request.headers.get("X-Twilio-Signature", "")
+    ):
+        logger.warning("Rejected request with invalid Twilio signature: %s", request.url.path)
+        raise HTTPException(status_code=403, detail="Invalid Twilio signature")
+
+    return dict(pairs)
+
+
+@app.api_route("/voice/inbound", methods=["GET", "POST"], response_class=TwiMLResponse)
+async def voice_inbound(request: Request) -> TwiMLResponse:
     """
     Handle incoming Twilio calls and connect them to ElevenLabs AI agent.
     Accepts both GET and POST requests as Twilio can use either method.
     """
-    # Parse form data (Twilio sends call parameters as form data)
-    form = await request.form()
-    from_number = form.get("From", "Unknown")
-    to_number = form.get("To", "Unknown")
-    call_sid = form.get("CallSid", "Unknown")
-    
+    fields = await twilio_params(request)
+    from_number = fields.get("From", "Unknown")
+    to_number = fields.get("To", "Unknown")
+    call_sid = fields.get("CallSid", "Unknown")
+
     logger.info("Inbound call - From: %s, To: %s, CallSid: %s", from_number, to_number, call_sid)
     
-    # TwiML response that connects the call to ElevenLabs
-    # Using <Connect> with <Stream> to send audio to ElevenLabs
-    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response>
-    <Connect>
-        <Stream url="wss://api.elevenlabs.io/v1/convai/conversation?agent_id={ELEVENLABS_AGENT_ID}">
-            <Parameter name="call_sid" value="{call_sid}" />
-            <Parameter name="from" value="{from_number}" />
-        </Stream>
-    </Connect>
-</Response>"""
+    params = (
+        f'<Parameter name="call_sid" value="{escape(call_sid, _XML_ATTR_ENTITIES)}"/>'
+        f'<Parameter name="from" value="{escape(from_number, _XML_ATTR_ENTITIES)}"/>'
+    )
+    xml = _VOICE_INBOUND_HEAD + params.encode() + _VOICE_INBOUND_TAIL
     
-    return Response(content=xml, media_type="text/xml")
+    return TwiMLResponse(xml)
 
 
 # --------------------------------------------------------------------
 # WEBHOOK: ELEVENLABS CALLBACK
 # ElevenLabs calls this endpoint after the conversation to send appointment data
 # --------------------------------------------------------------------
+class WebhookPayload(BaseModel):
+    """
+    Appointment details sent by ElevenLabs.
+    Adjust these fields based on actual ElevenLabs webhook structure;
+    unknown fields are ignored.
+    """
+    summary: str = "Appointment from MAXI"
+    description: str = ""
+    conversation_id: Optional[str] = None
+
+
+# ElevenLabs may redeliver a webhook; a conversation_id seen within
+# WEBHOOK_DEDUP_TTL seconds is acknowledged without creating another event.
+# The cache is per worker process, so a retry handled by another worker
+# is not caught.
+WEBHOOK_DEDUP_TTL = 60.0
+WEBHOOK_DEDUP_MAX = 1024
+_recent_webhooks: dict = {}  # conversation_id -> time.monotonic() first seen
+
+
+def is_duplicate_webhook(payload: WebhookPayload) -> bool:
+    """
+    Record the payload and report whether its conversation was already seen
+    within the TTL. Payloads without a conversation_id are never duplicates,
+    since different calls can carry identical appointment text.
+    """
+    key = payload.conversation_id
+    if not key:
+        return False
+    now = time.monotonic()
+
+    seen = _recent_webhooks.get(key)
+    if seen is not None and now - seen < WEBHOOK_DEDUP_TTL:
+        return True
+
+    if len(_recent_webhooks) >= WEBHOOK_DEDUP_MAX:
+        for k, t in list(_recent_webhooks.items()):
+            if now - t >= WEBHOOK_DEDUP_TTL:
+                del _recent_webhooks[k]
+    _recent_webhooks[key] = now
+    return False
+
+
 @app.post("/webhook")
-async def webhook(request: Request):
+async def webhook(payload: WebhookPayload, background_tasks: BackgroundTasks) -> ORJSONResponse:
     """
     Handle webhook callbacks from ElevenLabs with appointment data.
-    Creates a calendar event based on the appointment information.
+    Acknowledges immediately with 202; the calendar event is created in the
+    background after the response is sent.
     """
-    try:
-        data = await request.json()
-        logger.info("Received webhook from ElevenLabs: %s", json.dumps(data, indent=2))
-        
-        # Extract appointment details from the webhook payload
-        # Adjust these fields based on actual ElevenLabs webhook structure
-        summary = data.get("summary", "Appointment from MAXI")
-        description = data.get("description", "")
-        
-        # Create calendar event
-        create_calendar_event(summary, description)
-        
-        return JSONResponse(
-            content={"status": "success", "message": "Appointment processed"},
+    logger.info("Received webhook from ElevenLabs: %s", payload.summary)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook payload: %s", payload.model_dump_json())
+
+    if is_duplicate_webhook(payload):
+        logger.info("Ignoring duplicate webhook: %s", payload.summary)
+        return ORJSONResponse(
+            content={"status": "duplicate", "message": "Appointment already queued"},
             status_code=200
         )
-    except Exception as e:
-        logger.error("Error processing webhook: %s", e)
-        return JSONResponse(
-            content={"status": "error", "message": str(e)},
-            status_code=500
-        )
+
+    # Create calendar event
+    background_tasks.add_task(create_calendar_event, payload.summary, payload.description)
+
+    return ORJSONResponse(
+        content={"status": "accepted", "message": "Appointment queued"},
+        status_code=202
+    )
 
 
 # --------------------------------------------------------------------
 # HEALTH CHECK
 # --------------------------------------------------------------------
+# The body is rebuilt at most once per second (the timestamp has
+# whole-second precision) and reused by every health check within that second.
+_health_second = 0
+_health_body = b""
+
+
 @app.get("/health")
-def health():
-    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+async def health() -> Response:
+    global _health_second, _health_body
+    second = int(time.time())
+    if second != _health_second:
+        timestamp = datetime.fromtimestamp(second, timezone.utc).isoformat()
+        _health_body = orjson.dumps({"status": "healthy", "timestamp": timestamp})
+        _health_second = second
+    return Response(content=_health_body, media_type="application/json")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop + httptools are installed by uvicorn[standard]; each worker
+    # process builds its own HTTP client on startup.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        # One worker unless asked for more: in containers os.cpu_count() reports
+        # the host's CPUs, and each worker holds its own clients and dedup cache.
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        # When set, requests beyond this many in flight per worker get a 503
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "0")) or None,
+        # The handlers log what matters; a per-request access line is pure overhead
+        access_log=False,
+        # Keep uvicorn's loggers on the root handler so LOG_FORMAT applies to them
+        log_config=None,
+    )
@@ -0,0 +1,94 @@
+"""
+Checks for X-Twilio-Signature validation on /voice/inbound.
+
+Run with: python -m unittest test_twilio_signature
+"""
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from twilio.request_validator import RequestValidator
+
+import main
+
+TOKEN = "12345"
+URL = "https://example.com/voice/inbound"
+PARAMS = {"CallSid": "CA123", "From": "+14158675310", "To": "+18005551212", "Digits": ""}
+
+
+class SignatureTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(main, "TWILIO_AUTH_TOKEN", TOKEN)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_twilio_request_validator(self):
+        validator = RequestValidator(TOKEN)
+        signature = validator.compute_signature(URL, PARAMS)
+        self.assertTrue(main.twilio_signature_valid(URL, list(PARAMS.items()), signature))
+        self.assertTrue(validator.validate(URL, PARAMS, signature))
+
+    def test_matches_twilio_request_validator_for_get(self):
+        url = URL + "?CallSid=CA123&From=%2B14158675310"
+        signature = RequestValidator(TOKEN).compute_signature(url, {})
+        self.assertTrue(main.twilio_signature_valid(url, [], signature))
+
+    def test_rejects_tampered_params(self):
+        signature = RequestValidator(TOKEN).compute_signature(URL, PARAMS)
+        tampered = dict(PARAMS, From="+10000000000")
+        self.assertFalse(main.twilio_signature_valid(URL, list(tampered.items()), signature))
+
+    def test_rejects_non_ascii_signature(self):
+        self.assertFalse(main.twilio_signature_valid(URL, [], "é"))
+
+    def test_rejects_everything_without_auth_token(self):
+        signature = RequestValidator("").compute_signature(URL, PARAMS)
+        with mock.patch.object(main, "TWILIO_AUTH_TOKEN", None):
+            self.assertFalse(main.twilio_signature_valid(URL, list(PARAMS.items()), signature))
+
+
+class VoiceInboundValidationTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (("TWILIO_AUTH_TOKEN", TOKEN), ("TWILIO_VALIDATE_SIGNATURE", True)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(main.app, base_url="https://example.com")
+
+    def post(self, content, signature):
+        return self.client.post(
+            "/voice/inbound",
+            content=content,
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "X-Twilio-Signature": signature,
+            },
+        )
+
+    def test_accepts_signed_request(self):
+        signature = RequestValidator(TOKEN).compute_signature(URL, PARAMS)
+        response = self.client.post("/voice/inbound", data=PARAMS, headers={"X-Twilio-Signature": signature})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<Connect>", response.content)
+
+    def test_rejects_forged_request_without_auth_token(self):
+        signature = RequestValidator("").compute_signature(URL, PARAMS)
+        with mock.patch.object(main, "TWILIO_AUTH_TOKEN", None):
+            response = self.client.post("/voice/inbound", data=PARAMS, headers={"X-Twilio-Signature": signature})
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_non_ascii_signature_header(self):
+        response = self.post(b"CallSid=CA123", "é".encode("latin-1"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_non_utf8_body(self):
+        response = self.post(b"From=%FF\xff", "x")
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_too_many_fields(self):
+        response = self.post("&".join(f"f{i}=1" for i in range(101)).encode(), "x")
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()